@@ -1,20 +1,55 @@
-import pandas as pd
+import math
+from functools import lru_cache
+from operator import itemgetter
 import numpy as np
 import jenkspy
+from scipy.sparse import csr_matrix
+from scipy.spatial.distance import pdist, squareform
+from numba import njit, prange
 from brix import Indicator
 
+@lru_cache(maxsize=8)
+def _build_propagator(N, gamma):
+    '''
+    Returns a compiled function that computes the exposure of every cell to patents, evaluating exp(-gamma*d) on the fly instead of using a cached kernel.
+    N and gamma are baked in as compile-time constants, so a new function is only compiled when the grid or gamma change.
+    Rows are independent, so they are split across threads. dis is the condensed distance vector built by Giants.make_dis_df.
+    '''
+    @njit(parallel=True, fastmath=True)
+    def propagate(dis, patents):
+        out = np.zeros(N)
+        for i in prange(N):
+            acc = 0.
+            for j in range(i):
+                if patents[j]!=0:
+                    acc += math.exp(-gamma*dis[N*j-j*(j+1)//2+i-j-1])*patents[j]
+            row = N*i-i*(i+1)//2-i-1
+            for j in range(i+1,N):
+                if patents[j]!=0:
+                    acc += math.exp(-gamma*dis[row+j])*patents[j]
+            out[i] = acc
+        return out
+    return propagate
+
 class Giants(Indicator):
     '''
     Indicator that simulates the benefit that university researchers get from being in close proximity to private R&D.
     User can change location of academic departments and of private R&D labs, and the module will compute the research output of academia and display it as the height of each cell.
 
     color_method can be 'jenks', 'quantile', or 'none'
+    dtype is the floating point type of the cached spillover kernel (np.float32 by default, np.float64 for full precision); it has no effect when precompute_kernel=False
+    eps, if given (e.g. 1e-4), is the smallest spillover weight kept in the kernel, which is then stored as a sparse matrix (not available for np.float16)
+    precompute_kernel=False skips the cached kernel and evaluates every spillover weight on each update (exact, and no NxN kernel in memory)
     '''
-    def setup(self,quietly=True,color_method='jenks'):
+    def setup(self,quietly=True,color_method='jenks',dtype=np.float32,eps=None,precompute_kernel=True):
         self.quietly = quietly
         if not self.quietly:
             print('Setting up indicator')
         self.dis = None
+        self.K = None
+        self.id_index = None
+        self.patents_prev = None
+        self.exp_prev = None
         self.local_crs = 'ESRI:102008'
         self.name = 'Knowledge spillovers'
         self.indicator_type = 'grid'
@@ -26,6 +61,11 @@ class Giants(Indicator):
         self.beta1 = 0.06
         
         self.color_method = color_method
+        if eps and np.dtype(dtype)==np.float16:
+            raise ValueError('eps requires a sparse kernel, which scipy does not support for np.float16')
+        self.dtype = dtype
+        self.eps = eps
+        self.precompute_kernel = precompute_kernel
         
         self.scale = 2
         self.background_alpha = 0.5
@@ -42,9 +82,33 @@ class Giants(Indicator):
         self.academic_color = None
         self.set_color_palette()
 
+    @property
+    def gamma(self):
+        '''
+        Distance decay of spillovers. Setting it invalidates the cached kernel (see self.make_kernel).
+        '''
+        return self._gamma
+
+    @gamma.setter
+    def gamma(self,value):
+        self._gamma = value
+        self.K = None
+
+    @property
+    def units_alpha(self):
+        '''
+        Opacity of non-default cells. Setting it invalidates the color palette (see self.set_color_palette).
+        '''
+        return self._units_alpha
+
+    @units_alpha.setter
+    def units_alpha(self,value):
+        self._units_alpha = value
+        self.color_palette = None
+
     def set_color_palette(self):
         '''
-        Sets the color palette to be used according to self.n_colors
+        Sets the color palette to be used according to self.n_colors, as an RGBA array with self.units_alpha
         '''
         self.Reds = {
             3: [(254,224,210), (252,146,114), (222,45,38)],
@@ -56,8 +120,9 @@ class Giants(Indicator):
             9: [(255,245,240), (254,224,210), (252,187,161), (252,146,114), (251,106,74), (239,59,44), (203,24,29), (165,15,21), (103,0,13)]
         }
 
-        color_palette = self.Reds[self.n_colors]
-        self.color_palette = [list(c) for c in color_palette]
+        palette = np.array(self.Reds[self.n_colors], dtype=np.uint8)
+        alpha = np.full((self.n_colors,1), int(self.units_alpha*255), dtype=np.uint8)
+        self.color_palette = np.hstack([palette, alpha])
 
     def set_academic_color(self,geogrid_data):
         '''
@@ -69,20 +134,42 @@ class Giants(Indicator):
         
     def make_dis_df(self,geogrid_data):
         '''
-        Initialize a dataframe with distances between all pairs of cells.
+        Initialize the distances between all pairs of cells, in condensed form (see scipy.spatial.distance.pdist).
+        They are kept in float32 unless the kernel is float64 or computed on the fly, which need full precision.
+        Cells are numbered as in self.id_index.
         This takes a bit, but makes updates run faster.
         '''
         if not self.quietly:
             print('Calculating distances between cells (may take a bit)')
         geogrid_data_df = geogrid_data.as_df()
-        dis = geogrid_data_df[['id','geometry']]
-        dis = dis.to_crs(self.local_crs)
-        dis.geometry = dis.geometry.centroid
-        dis['flag'] = 1
-        dis = pd.merge(dis,dis,on='flag').drop('flag',1)
-        dis = dis[dis['id_x']!=dis['id_y']]
-        dis['distance'] = [x.distance(y) for x,y in dis[['geometry_x','geometry_y']].values]
-        self.dis = dis[['id_x','id_y','distance']]
+        centroids = geogrid_data_df.geometry.to_crs(self.local_crs).centroid
+        xy = np.stack([centroids.x.values, centroids.y.values], axis=1).astype(np.float64)
+        if self.precompute_kernel and np.dtype(self.dtype)!=np.float64:
+            self.dis = pdist(xy).astype(np.float32)
+        else:
+            self.dis = pdist(xy)
+        self.id_index = {id: i for i, id in enumerate(geogrid_data_df['id'].values)}
+        self.K = None
+
+    def make_kernel(self):
+        '''
+        Caches the spillover weights exp(-gamma*d) between all pairs of cells as a matrix.
+        Weights below self.eps are dropped and the matrix is stored as sparse.
+        Distances do not change, so this only needs to be redone when gamma changes.
+        '''
+        self.exp_prev = None
+        weights = np.exp(-self.gamma*self.dis).astype(self.dtype)
+        if self.eps:
+            N = len(self.id_index)
+            k = np.flatnonzero(weights>=self.eps)
+            rows = np.arange(N)
+            starts = N*rows - rows*(rows+1)//2
+            i = np.searchsorted(starts, k, side='right')-1
+            j = k-starts[i]+i+1
+            w = weights[k]
+            self.K = csr_matrix((np.concatenate([w,w]),(np.concatenate([i,j]),np.concatenate([j,i]))), shape=(N,N))
+        else:
+            self.K = squareform(weights)
         
     def return_indicator(self,geogrid_data):
         '''
@@ -90,75 +177,101 @@ class Giants(Indicator):
         '''
         if self.dis is None:
             self.make_dis_df(geogrid_data)
+        if self.precompute_kernel and self.K is None:
+            self.make_kernel()
+        if self.color_palette is None:
+            self.set_color_palette()
         self.set_academic_color(geogrid_data)
-        final_height_lookup = self.propagate_spillovers(geogrid_data)
-        self.set_breaks(final_height_lookup)
-        
-        for cell in geogrid_data:
-            if cell['id'] in final_height_lookup.keys():
-                h = final_height_lookup[cell['id']]
-                cell['height'] = self.scale*min([1000,h])
-                cell['color'] = self.get_color(h)
-            elif cell['name'] == 'Default':
-                cell['height'] = 0
-            else:
-                cell['height'] = self.scale*self.base_height
 
-            if cell['name']=='Default':
-                cell['color'] = cell['color'][:3]+[int(self.background_alpha*255)]
-            else:
-                cell['color'] = cell['color'][:3]+[int(self.units_alpha*255)]
+        cells = list(geogrid_data)
+        codes = np.fromiter(map(self.id_index.__getitem__, map(itemgetter('id'), cells)), dtype=np.int32, count=len(cells))
+        names = np.array(list(map(itemgetter('name'), cells)), dtype=object)
+        colors = map(itemgetter('color'), cells)
+
+        final_heights = self.propagate_spillovers(codes, names)
+        self.set_breaks(final_heights)
+
+        h = final_heights[codes]
+        is_academic = ~np.isnan(h)
+        is_default = names=='Default'
+        heights = np.where(is_academic, self.scale*np.minimum(1000,h), np.where(is_default, 0, self.scale*self.base_height))
+        alphas = np.where(is_default, int(self.background_alpha*255), int(self.units_alpha*255))
+        academic_colors = iter(self.get_colors(h[is_academic]).tolist())
+
+        for cell,height,color,academic,alpha in zip(cells,heights.tolist(),colors,is_academic.tolist(),alphas.tolist()):
+            cell['height'] = height
+            cell['color'] = next(academic_colors) if academic else [color[0],color[1],color[2],alpha]
             if 'geometry' in cell.keys():
                 del cell['geometry']
         return geogrid_data
 
-    def propagate_spillovers(self,geogrid_data):
+    def propagate_spillovers(self,codes,names):
         '''
         Main function of the indicator.
         Calculates exposures and uses the model parameters to simulate the effect on university research.
-        Returns a dictionary with cell ids as keys and the simulated research output as values.
+        codes are the rows of the cells in self.id_index and names their types.
+        Returns an array with the simulated research output of each cell (rows follow self.id_index), NaN for non-academic cells.
         '''
         if not self.quietly:
             print('Propagating spillovers')
-        geogrid_data_df = geogrid_data.as_df()
-        geogrid_data_df.loc[geogrid_data_df['name'].isin(set(self.academic_types|self.private_types)),'height'] = self.base_height
+        academic_codes = codes[np.isin(names, list(self.academic_types))]
+        private_codes  = codes[np.isin(names, list(self.private_types))]
 
-        academic = geogrid_data_df[geogrid_data_df['name'].isin(self.academic_types)]
-        private  = geogrid_data_df[geogrid_data_df['name'].isin(self.private_types)]
+        final_heights = np.full(len(self.id_index), np.nan)
+        if len(academic_codes)==0 or len(private_codes)==0:
+            return final_heights
 
-        exp = pd.merge(self.dis,private[['id','height']].rename(columns={'id':'id_y','height':'patents'}))
-        exp['exp'] = np.exp(-self.gamma*exp['distance'])*exp['patents']
-        exp = exp.groupby('id_x').sum()[['exp']].reset_index().rename(columns={'id_x':'id'})
-        exp.loc[exp['exp']>50,'exp'] = 50
+        patents = np.zeros(len(self.id_index), dtype=self.dtype if self.precompute_kernel else np.float64)
+        patents[private_codes] = self.base_height
+        if self.precompute_kernel:
+            exp_vec = self.get_exposures(patents)
+        else:
+            exp_vec = _build_propagator(len(self.id_index), self.gamma)(self.dis, patents)
+        exp_vec = np.minimum(exp_vec, 50)
 
-        academic = pd.merge(academic,exp)
-        academic['final'] = academic['height']*np.exp(self.beta0+self.beta1*academic['exp'])
-        final_height_lookup = dict(academic[['id','final']].values)
-        return final_height_lookup
+        final_heights[academic_codes] = self.base_height*np.exp(self.beta0+self.beta1*exp_vec[academic_codes])
+        return final_heights
 
-    def set_breaks(self,final_height_lookup):
+    def get_exposures(self,patents):
+        '''
+        Returns the exposure of every cell to patents using the cached kernel (see self.make_kernel).
+        Exposures from the previous update are reused, so only the columns of cells whose patents changed are added.
+        '''
+        if self.exp_prev is None:
+            exp_vec = (self.K @ patents).astype(np.float64)
+        else:
+            diff = patents-self.patents_prev
+            changed = np.flatnonzero(diff)
+            exp_vec = self.exp_prev + self.K[:,changed] @ diff[changed]
+        self.patents_prev = patents
+        self.exp_prev = exp_vec
+        return exp_vec
+
+    def set_breaks(self,final_heights):
         '''
         Sets the breaks to be used to color cells.
         '''
-        if len(final_height_lookup)>0:
+        values = final_heights[~np.isnan(final_heights)]
+        if len(values)>0:
             if self.color_method == 'jenks':
-                breaks = jenkspy.jenks_breaks(final_height_lookup.values(), nb_class=self.n_colors)
+                breaks = jenkspy.jenks_breaks(values, nb_class=self.n_colors)
                 self.breaks = np.array(breaks)
             elif self.color_method == 'quantile':
-                breaks = [np.quantile(list(final_height_lookup.values()),q) for q in np.linspace(0,1,self.n_colors+1)]
-                self.breaks = np.array(breaks)
+                self.breaks = np.quantile(values, np.linspace(0,1,self.n_colors+1))
             else:
                 self.breaks = None
         else:
             self.breaks = None
     
-    def get_color(self,h):
+    def get_colors(self,final_heights):
         '''
-        Returns the color for height h according to self.breaks (see self.set_breaks)
+        Returns an array with the RGBA color for each of final_heights according to self.breaks (see self.set_breaks)
         '''
         if self.breaks is not None:
-            cat = min(min(np.where(self.breaks>=h)))
-            cell_color = self.color_palette[cat-1]
+            cats = np.searchsorted(self.breaks, final_heights, side='left')
+            cats = np.clip(cats, 1, self.n_colors)
+            cell_colors = self.color_palette[cats-1]
         else:
-            cell_color = self.academic_color
-        return cell_color
+            academic_color = np.array(self.academic_color+[int(self.units_alpha*255)], dtype=np.uint8)
+            cell_colors = np.broadcast_to(academic_color, (len(final_heights),4))
+        return cell_colors